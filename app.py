@@ -1,23 +1,40 @@
 import os
+import sys
 import uuid
+import queue
+import atexit
+import hmac
 import hashlib
 import sqlite3
 import threading
 import time
+import secrets
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 
+import orjson
 from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask.json.provider import JSONProvider
+from flask.sessions import SessionInterface, SessionMixin
+from flask_compress import Compress
 from flask_cors import CORS
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # --- App Initialization ---
 app = Flask(__name__, template_folder="templates", static_folder="static")
-# IMPORTANT: Change this secret key for production environments.
+# Sessions are stored server-side (see InMemorySessionInterface), so this key no longer signs the
+# session cookie; it is still used by anything else in Flask that signs data. Set a real key in production.
 # You can generate a secure key using: python -c 'import os; print(os.urandom(24))'
 app.config["SECRET_KEY"] = os.environ.get(
     "FLASK_SECRET_KEY", "a-very-secure-dev-secret-key"
 )
 app.permanent_session_lifetime = timedelta(hours=24)
+# Hash method for newly created passwords (werkzeug "method:hash:iterations" format).
+# check_password_hash reads the method from each stored hash, so existing hashes keep working.
+# Tune the iteration count so a single hash takes roughly 50-100ms on the deployment hardware.
+PASSWORD_HASH_METHOD = os.environ.get("PW_HASH", "pbkdf2:sha256:120000")
 
 CORS(
     app,
@@ -29,78 +46,308 @@ CORS(
     supports_credentials=True,
 )
 
+# Compress JSON API responses (analytics, history); tiny payloads are sent as-is.
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_LEVEL"] = 5
+app.config["COMPRESS_MIN_SIZE"] = 500
+Compress(app)
+
+
+# --- JSON Serialization ---
+def _orjson_default(obj):
+    # Lets routes pass sqlite3.Row results straight to jsonify.
+    if isinstance(obj, sqlite3.Row):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson; used by jsonify() and request.get_json()."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=_orjson_default), mimetype="application/json")
+
+
+app.json = OrjsonProvider(app)
+
+
+# --- Server-Side Sessions ---
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict whose contents live on the server; the client only holds ``sid``."""
+
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.previous_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        """Issue a fresh session id (call on login to prevent session fixation)."""
+        self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(16)
+        self.modified = True
+
+
+class InMemorySessionInterface(SessionInterface):
+    """Keep session data in process memory with a TTL, so each request carries a short opaque id cookie
+    instead of the full signed payload. Sessions are per process; run a single worker process."""
+
+    MAX_SESSIONS = 10000
+
+    def __init__(self):
+        # sid -> (expires_at epoch seconds, data), oldest write first.
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with self._lock:
+                entry = self._store.get(sid)
+                if entry and entry[0] <= time.time():
+                    del self._store[sid]
+                    entry = None
+            if entry:
+                return ServerSideSession(entry[1], sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(16))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        with self._lock:
+            if session.previous_sid:
+                self._store.pop(session.previous_sid, None)
+            if not session:
+                self._store.pop(session.sid, None)
+        if not session:
+            if session.modified:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+
+        with self._lock:
+            # An unmodified session is only refreshed if it still exists: a request that started before
+            # logout must not write the logged-out session back.
+            if session.sid not in self._store and not session.modified:
+                return
+            self._store[session.sid] = (time.time() + app.permanent_session_lifetime.total_seconds(), dict(session))
+            self._store.move_to_end(session.sid)
+            while len(self._store) > self.MAX_SESSIONS:
+                self._store.popitem(last=False)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            partitioned=self.get_cookie_partitioned(app),
+        )
+
+
+app.session_interface = InMemorySessionInterface()
+
 # --- Database Management (Singleton Pattern) ---
 class DatabaseManager:
     """Singleton to manage SQLite database initialization and connections."""
 
     _instance = None
+    # Maximum number of idle connections kept open for reuse across requests.
+    POOL_SIZE = 8
+    # How often to refresh query planner statistics with PRAGMA optimize.
+    OPTIMIZE_INTERVAL_SECONDS = 3600
+    # Per-connection settings; journal_mode=WAL is persisted in the file and set once in init_database.
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous=NORMAL;",
+        "PRAGMA temp_store=MEMORY;",
+        "PRAGMA mmap_size=268435456;",
+        "PRAGMA cache_size=-20000;",
+        "PRAGMA busy_timeout=5000;",
+        "PRAGMA foreign_keys=ON;",
+    )
 
     def __new__(cls, db_path="campus_guardian.db"):
         if cls._instance is None:
             cls._instance = super(DatabaseManager, cls).__new__(cls)
             cls._instance.db_path = db_path
+            cls._instance._local = threading.local()
+            cls._instance._pool = queue.Queue(maxsize=cls.POOL_SIZE)
             cls._instance.init_database()
+            cls._instance._start_optimizer()
+            atexit.register(cls._instance.optimize)
+            os.register_at_fork(after_in_child=cls._instance._after_fork)
         return cls._instance
 
-    def get_connection(self):
+    def _start_optimizer(self):
+        threading.Thread(target=self._optimize_loop, name="db-optimizer", daemon=True).start()
+
+    def _after_fork(self):
+        # SQLite handles must not cross fork (e.g. gunicorn workers), and threads do not survive it.
+        self._local = threading.local()
+        self._pool = queue.Queue(maxsize=self.POOL_SIZE)
+        self._start_optimizer()
+
+    def _open_connection(self):
         conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        try:
+            for pragma in self.CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+        except sqlite3.OperationalError:
+            app.logger.warning("Could not apply connection PRAGMAs (database may be locked)")
         return conn
 
-    def init_database(self):
-        """Create tables and seed default data if needed."""
+    def get_connection(self):
+        """Return the connection bound to the current thread, reusing an idle pooled one if available."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = self._open_connection()
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def _release_connection(self):
+        conn = self._local.conn
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow the thread's connection; rolls back on error and returns it to the pool instead of closing."""
         conn = self.get_connection()
+        self._local.depth += 1
         try:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.executescript(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT UNIQUE NOT NULL,
-                    name TEXT NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    role TEXT NOT NULL CHECK (role IN ('student', 'teacher')),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                CREATE TABLE IF NOT EXISTS classes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    class_name TEXT NOT NULL,
-                    teacher_id TEXT NOT NULL,
-                    class_code TEXT UNIQUE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (teacher_id) REFERENCES users (user_id)
-                );
-                CREATE TABLE IF NOT EXISTS attendance (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    student_id TEXT NOT NULL,
-                    class_id INTEGER NOT NULL,
-                    attendance_date DATE NOT NULL,
-                    status TEXT DEFAULT 'present',
-                    marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (student_id) REFERENCES users (user_id),
-                    FOREIGN KEY (class_id) REFERENCES classes (id),
-                    UNIQUE(student_id, class_id, attendance_date)
-                );
-                CREATE TABLE IF NOT EXISTS qr_sessions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT UNIQUE NOT NULL,
-                    class_id INTEGER NOT NULL,
-                    teacher_id TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    FOREIGN KEY (class_id) REFERENCES classes (id),
-                    FOREIGN KEY (teacher_id) REFERENCES users (user_id)
-                );
-                """
-            )
-            conn.commit()
-            self._create_default_data(conn)
-        except Exception as e:
-            app.logger.exception("Database initialization error")
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
         finally:
-            conn.close()
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                self._release_connection()
+
+    def init_database(self):
+        """Create tables and seed default data if needed."""
+        with self.connection() as conn:
+            try:
+                conn.execute("PRAGMA journal_mode=WAL;")
+                conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id TEXT UNIQUE NOT NULL,
+                        name TEXT NOT NULL,
+                        email TEXT UNIQUE NOT NULL,
+                        password_hash TEXT NOT NULL,
+                        role TEXT NOT NULL CHECK (role IN ('student', 'teacher')),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                    CREATE TABLE IF NOT EXISTS classes (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        class_name TEXT NOT NULL,
+                        teacher_id TEXT NOT NULL,
+                        class_code TEXT UNIQUE NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (teacher_id) REFERENCES users (user_id)
+                    );
+                    CREATE TABLE IF NOT EXISTS attendance (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        student_id TEXT NOT NULL,
+                        class_id INTEGER NOT NULL,
+                        attendance_date DATE NOT NULL,
+                        status TEXT DEFAULT 'present',
+                        marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (student_id) REFERENCES users (user_id),
+                        FOREIGN KEY (class_id) REFERENCES classes (id),
+                        UNIQUE(student_id, class_id, attendance_date)
+                    );
+                    CREATE TABLE IF NOT EXISTS qr_sessions (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        session_id TEXT UNIQUE NOT NULL,
+                        class_id INTEGER NOT NULL,
+                        teacher_id TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        expires_at INTEGER NOT NULL,
+                        is_active BOOLEAN DEFAULT TRUE,
+                        FOREIGN KEY (class_id) REFERENCES classes (id),
+                        FOREIGN KEY (teacher_id) REFERENCES users (user_id)
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_att_student_date ON attendance (student_id, attendance_date DESC);
+                    CREATE INDEX IF NOT EXISTS idx_att_class_date ON attendance (class_id, attendance_date);
+                    CREATE INDEX IF NOT EXISTS idx_qr_active ON qr_sessions (teacher_id, is_active);
+                    CREATE INDEX IF NOT EXISTS idx_classes_teacher ON classes (teacher_id, class_code);
+                    -- Rollup setup is one transaction: the backfill and the trigger that keeps it current
+                    -- commit together, so no attendance row can fall between them.
+                    BEGIN IMMEDIATE;
+                    -- Superseded per-student rollup from earlier builds.
+                    DROP TRIGGER IF EXISTS trg_attendance_rollup;
+                    DROP TABLE IF EXISTS attendance_rollup;
+                    CREATE TABLE IF NOT EXISTS attendance_class_rollup (
+                        class_id INTEGER PRIMARY KEY,
+                        marks INTEGER NOT NULL DEFAULT 0,
+                        FOREIGN KEY (class_id) REFERENCES classes (id)
+                    );
+                    -- Backfill once, for databases created before the rollup existed (the trigger marks it done).
+                    INSERT INTO attendance_class_rollup (class_id, marks)
+                    SELECT class_id, COUNT(*)
+                    FROM attendance
+                    WHERE NOT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_attendance_class_rollup')
+                    GROUP BY class_id;
+                    CREATE TRIGGER IF NOT EXISTS trg_attendance_class_rollup AFTER INSERT ON attendance
+                    BEGIN
+                        INSERT INTO attendance_class_rollup (class_id, marks) VALUES (NEW.class_id, 1)
+                        ON CONFLICT (class_id) DO UPDATE SET marks = marks + 1;
+                    END;
+                    COMMIT;
+                    -- Convert ISO-8601 expiries written by older versions to epoch seconds.
+                    UPDATE qr_sessions SET expires_at = CAST(strftime('%s', expires_at) AS INTEGER)
+                    WHERE typeof(expires_at) = 'text';
+                    """
+                )
+                conn.commit()
+                self._create_default_data(conn)
+                # Gather planner statistics so the attendance indexes are chosen over table scans. analysis_limit
+                # makes ANALYZE sample each index instead of scanning it, so startup cost does not grow with the table.
+                conn.execute("PRAGMA analysis_limit=400;")
+                conn.execute("ANALYZE;")
+            except Exception as e:
+                app.logger.exception("Database initialization error")
+
+    def optimize(self):
+        """Let SQLite re-analyze tables whose statistics have drifted."""
+        try:
+            with self.connection() as conn:
+                conn.execute("PRAGMA optimize;")
+        except sqlite3.Error:
+            app.logger.exception("PRAGMA optimize failed")
+
+    def _optimize_loop(self):
+        while True:
+            time.sleep(self.OPTIMIZE_INTERVAL_SECONDS)
+            self.optimize()
 
     def _create_default_data(self, conn):
         """Insert a default teacher, student and class for development/demo."""
@@ -114,7 +361,7 @@ class DatabaseManager:
                     "teacher001",
                     "Dr. Ada Lovelace",
                     "teacher@campus.edu",
-                    generate_password_hash(teacher_pass),
+                    generate_password_hash(teacher_pass, method=PASSWORD_HASH_METHOD),
                     "teacher",
                 ),
             )
@@ -124,7 +371,7 @@ class DatabaseManager:
                     "2024001",
                     "Alan Turing",
                     "student@campus.edu",
-                    generate_password_hash(student_pass),
+                    generate_password_hash(student_pass, method=PASSWORD_HASH_METHOD),
                     "student",
                 ),
             )
@@ -144,91 +391,158 @@ class QRCodeManager:
     def __init__(self):
         self.active_session = {}
         self.lock = threading.Lock()
+        # (session_id, token_window) -> token; guarded by self.lock.
+        self._token_cache = {}
         try:
-            self._load_active_session_from_db()
+            self.reload_from_db()
         except Exception:
             app.logger.exception("Failed to load active QR session during startup")
+        # Expiry bookkeeping runs on a background tick so token requests never touch the database.
+        self._start_reaper()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _start_reaper(self):
+        threading.Thread(target=self._reap_loop, name="qr-session-reaper", daemon=True).start()
 
-    def _load_active_session_from_db(self):
-        conn = db_manager.get_connection()
+    def _after_fork(self):
+        # A forked child (e.g. gunicorn --preload) must not keep serving the parent's in-memory session,
+        # which may have been stopped since; the database is the source of truth at this point.
+        self.lock = threading.Lock()
+        self.active_session = {}
+        self._token_cache = {}
         try:
+            self.reload_from_db()
+        except Exception:
+            app.logger.exception("Failed to reload active QR session after fork")
+        self._start_reaper()
+
+    def reload_from_db(self):
+        """Load the latest active session from the database. Called at startup and in forked children;
+        after that this process's in-memory session is authoritative and the token request path serves
+        from memory via _has_live_session."""
+        with self.lock, db_manager.connection() as conn:
             row = conn.execute(
                 "SELECT session_id, class_id, teacher_id, expires_at FROM qr_sessions WHERE is_active = 1 ORDER BY created_at DESC LIMIT 1"
             ).fetchone()
             if row:
-                expires_at = datetime.fromisoformat(row["expires_at"]).replace(tzinfo=timezone.utc)
-                if datetime.now(timezone.utc) < expires_at:
+                expires_at = row["expires_at"]
+                if time.time() < expires_at:
                     self.active_session = {
                         "session_id": row["session_id"],
                         "class_id": row["class_id"],
                         "teacher_id": row["teacher_id"],
                         "expires_at": expires_at,
+                        "_sid_bytes": row["session_id"].encode() + b":",
                     }
                 else:
                     conn.execute("UPDATE qr_sessions SET is_active = 0 WHERE session_id = ?", (row["session_id"],))
                     conn.commit()
-        finally:
-            conn.close()
 
-    def start_session(self, class_id, teacher_id, duration_minutes=60):
+    def start_session(self, class_code, teacher_id, duration_minutes=60):
+        """Start a session for the teacher's class. Returns None if the class does not exist or belongs to someone else."""
         with self.lock:
             session_id = str(uuid.uuid4())
-            expires_at = datetime.now(timezone.utc) + timedelta(minutes=int(duration_minutes))
-            conn = db_manager.get_connection()
-            try:
-                conn.execute("UPDATE qr_sessions SET is_active = 0 WHERE teacher_id = ? AND is_active = 1", (teacher_id,))
+            expires_at = int(time.time()) + int(duration_minutes) * 60
+            with db_manager.connection() as conn:
+                # Take the write lock up front so the insert + deactivate commit as one transaction.
+                conn.execute("BEGIN IMMEDIATE")
+                # The class ownership check is part of the insert: no row is inserted for an unauthorized class.
+                inserted = conn.execute(
+                    """
+                    INSERT INTO qr_sessions (session_id, class_id, teacher_id, expires_at, is_active)
+                    SELECT ?, id, teacher_id, ?, 1 FROM classes WHERE class_code = ? AND teacher_id = ?
+                    RETURNING class_id, (SELECT class_name FROM classes WHERE classes.id = qr_sessions.class_id) as class_name
+                    """,
+                    (session_id, expires_at, class_code, teacher_id),
+                ).fetchall()
+                if not inserted:
+                    conn.rollback()
+                    return None
                 conn.execute(
-                    "INSERT INTO qr_sessions (session_id, class_id, teacher_id, expires_at, is_active) VALUES (?, ?, ?, ?, 1)",
-                    (session_id, class_id, teacher_id, expires_at.isoformat()),
+                    "UPDATE qr_sessions SET is_active = 0 WHERE teacher_id = ? AND is_active = 1 AND session_id != ?",
+                    (teacher_id, session_id),
                 )
                 conn.commit()
                 self.active_session = {
                     "session_id": session_id,
-                    "class_id": class_id,
+                    "class_id": inserted[0]["class_id"],
                     "teacher_id": teacher_id,
                     "expires_at": expires_at,
+                    "_sid_bytes": session_id.encode() + b":",
                 }
-                return self.active_session
-            finally:
-                conn.close()
+                return dict(self.active_session, class_name=inserted[0]["class_name"])
 
     def stop_session(self):
         with self.lock:
             if self.active_session:
-                conn = db_manager.get_connection()
-                try:
+                with db_manager.connection() as conn:
                     conn.execute("UPDATE qr_sessions SET is_active = 0 WHERE session_id = ?", (self.active_session["session_id"],))
                     conn.commit()
-                finally:
-                    conn.close()
             self.active_session = {}
         return True
 
-    def _ensure_session_is_active(self):
-        if not self.active_session or datetime.now(timezone.utc) >= self.active_session.get("expires_at", datetime.min.replace(tzinfo=timezone.utc)):
-            self._load_active_session_from_db()
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.TOKEN_WINDOW_SECONDS)
+            try:
+                self._reap_expired_sessions()
+            except Exception:
+                app.logger.exception("Failed to reap expired QR sessions")
+
+    def _reap_expired_sessions(self):
+        """Evict the in-memory session once it expires and deactivate expired rows in the database."""
+        now = int(time.time())
+        with self.lock:
+            if self.active_session and now >= self.active_session["expires_at"]:
+                self.active_session = {}
+                self._token_cache = {}
+        with db_manager.connection() as conn:
+            # Probe with a read first so an idle server never takes the write lock.
+            if conn.execute("SELECT 1 FROM qr_sessions WHERE is_active = 1 AND expires_at < ? LIMIT 1", (now,)).fetchone():
+                conn.execute("UPDATE qr_sessions SET is_active = 0 WHERE is_active = 1 AND expires_at < ?", (now,))
+                conn.commit()
+
+    def _token_for(self, token_window):
+        """Return the active session's token for a window, hashing only on a cache miss. Caller must hold self.lock."""
+        session_id = self.active_session["session_id"]
+        key = (session_id, token_window)
+        token = self._token_cache.get(key)
+        if token is None:
+            token = hashlib.sha256(self.active_session["_sid_bytes"] + str(token_window).encode()).hexdigest()[:16]
+            # Only the current and previous windows are ever requested, so drop everything older.
+            self._token_cache = {
+                k: v for k, v in self._token_cache.items() if k[0] == session_id and k[1] >= token_window - 1
+            }
+            self._token_cache[key] = token
+        return token
+
+    def _has_live_session(self):
+        """Cheap in-memory expiry check for the request path. Caller must hold self.lock."""
+        return bool(self.active_session) and time.time() < self.active_session["expires_at"]
 
     def get_current_token(self):
         with self.lock:
-            self._ensure_session_is_active()
-            if not self.active_session:
+            if not self._has_live_session():
                 return None
             token_window = int(time.time()) // self.TOKEN_WINDOW_SECONDS
-            token_data = f"{self.active_session['session_id']}:{token_window}"
-            token_hash = hashlib.sha256(token_data.encode()).hexdigest()[:16]
-            return {"token": token_hash, "session_id": self.active_session["session_id"]}
+            token_hash = self._token_for(token_window)
+            return {
+                "token": token_hash,
+                "session_id": self.active_session["session_id"],
+                "expires_at": self.active_session["expires_at"],
+            }
 
     def validate_token(self, token, session_id):
         with self.lock:
-            self._ensure_session_is_active()
-            if not self.active_session or self.active_session.get("session_id") != session_id:
+            if not self._has_live_session() or self.active_session["session_id"] != session_id:
+                return False
+            # compare_digest only accepts ASCII str, so reject anything else up front.
+            if not isinstance(token, str) or not token.isascii():
                 return False
 
             current_window = int(time.time()) // self.TOKEN_WINDOW_SECONDS
             for offset in (0, -1):
-                token_window = current_window + offset
-                expected_token = hashlib.sha256(f"{session_id}:{token_window}".encode()).hexdigest()[:16]
-                if token == expected_token:
+                if hmac.compare_digest(token, self._token_for(current_window + offset)):
                     return True
             return False
 
@@ -239,6 +553,11 @@ qr_manager = QRCodeManager()
 
 
 # --- Routes ---
+def iso_from_epoch(ts):
+    """Render epoch seconds as an ISO-8601 UTC string for API responses."""
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
 @app.route("/")
 def index():
     if "user_id" in session:
@@ -264,18 +583,16 @@ def login():
     if not user_id or not password:
         return jsonify({"success": False, "message": "User ID and password are required."}), 400
 
-    conn = db_manager.get_connection()
-    try:
+    with db_manager.connection() as conn:
         user_row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
         if user_row and check_password_hash(user_row["password_hash"], password):
+            session.regenerate()
             session.permanent = True
             session["user_id"] = user_row["user_id"]
             session["role"] = user_row["role"]
             user_data = {"user_id": user_row["user_id"], "name": user_row["name"], "role": user_row["role"]}
             return jsonify({"success": True, "user": user_data, "redirect": url_for("index")})
         return jsonify({"success": False, "message": "Invalid user ID or password."}), 401
-    finally:
-        conn.close()
 
 
 @app.route("/api/logout", methods=["POST"])
@@ -310,20 +627,15 @@ def generate_qr():
     if not class_code:
         return jsonify({"error": "Class code is required."}), 400
 
-    conn = db_manager.get_connection()
-    try:
-        class_info = conn.execute("SELECT id, class_name FROM classes WHERE class_code = ? AND teacher_id = ?", (class_code, session["user_id"])).fetchone()
-        if not class_info:
-            return jsonify({"error": "Class not found or you are not authorized to start a session for this class."}), 404
-        session_data = qr_manager.start_session(class_info["id"], session["user_id"], duration)
-        return jsonify({
-            "success": True,
-            "session_id": session_data["session_id"],
-            "class_name": class_info["class_name"],
-            "expires_at": session_data["expires_at"].isoformat()
-        })
-    finally:
-        conn.close()
+    session_data = qr_manager.start_session(class_code, session["user_id"], duration)
+    if not session_data:
+        return jsonify({"error": "Class not found or you are not authorized to start a session for this class."}), 404
+    return jsonify({
+        "success": True,
+        "session_id": session_data["session_id"],
+        "class_name": session_data["class_name"],
+        "expires_at": iso_from_epoch(session_data["expires_at"])
+    })
 
 
 @app.route("/api/teacher/stop-qr", methods=["POST"])
@@ -338,8 +650,7 @@ def stop_qr():
 def get_qr_token():
     token_data = qr_manager.get_current_token()
     if token_data:
-        if qr_manager.active_session.get("expires_at"):
-            token_data["expires_at"] = qr_manager.active_session["expires_at"].isoformat()
+        token_data["expires_at"] = iso_from_epoch(token_data["expires_at"])
         return jsonify(token_data)
     return jsonify({"error": "There is no active QR session."}), 404
 
@@ -350,17 +661,20 @@ def list_classes():
     if "user_id" not in session:
         return jsonify({"error": "Not authenticated."}), 401
     user_id = session["user_id"]
-    conn = db_manager.get_connection()
-    try:
+    with db_manager.connection() as conn:
         role = session.get("role")
         if role == "teacher":
             rows = conn.execute("SELECT id, class_name, class_code, created_at FROM classes WHERE teacher_id = ?", (user_id,)).fetchall()
-            return jsonify({"classes": [dict(r) for r in rows]})
+            return jsonify({"classes": rows})
         else:
-            rows = conn.execute("SELECT id, class_name, class_code, teacher_id FROM classes").fetchall()
-            return jsonify({"classes": [dict(r) for r in rows]})
-    finally:
-        conn.close()
+            rows = conn.execute(
+                """
+                SELECT c.id, c.class_name, c.class_code, c.teacher_id, u.name as teacher_name
+                FROM classes c
+                LEFT JOIN users u ON u.user_id = c.teacher_id
+                """
+            ).fetchall()
+            return jsonify({"classes": rows})
 
 
 @app.route("/api/teacher/analytics", methods=["GET"])
@@ -368,23 +682,49 @@ def teacher_analytics():
     if session.get("role") != "teacher":
         return jsonify({"error": "Only teachers can access analytics."}), 403
     teacher_id = session["user_id"]
-    conn = db_manager.get_connection()
-    try:
+    with db_manager.connection() as conn:
+        # Class aggregates and at-risk students are fetched in one statement; rows are split by "kind".
         rows = conn.execute(
             """
-            SELECT c.id as class_id, c.class_name,
-                COUNT(a.id) as marks,
-                (SELECT COUNT(DISTINCT a2.attendance_date) FROM attendance a2 WHERE a2.class_id = c.id AND a2.attendance_date >= date('now', '-30 days')) as days_count
-            FROM classes c
-            LEFT JOIN attendance a ON a.class_id = c.id
-            WHERE c.teacher_id = ?
-            GROUP BY c.id
+            WITH cls_agg AS (
+                SELECT c.id as class_id, c.class_name,
+                    r.marks,
+                    (SELECT COUNT(DISTINCT a.attendance_date) FROM attendance a WHERE a.class_id = c.id AND a.attendance_date >= date('now', '-30 days')) as days_count
+                FROM classes c
+                LEFT JOIN attendance_class_rollup r ON r.class_id = c.id
+                WHERE c.teacher_id = ?
+            ),
+            risk AS (
+                -- Windowed to the last 30 days, so this stays on attendance (covered by idx_att_class_date).
+                SELECT u.user_id, u.name, u.email, c.class_name,
+                    SUM(CASE WHEN a.status = 'present' THEN 1 ELSE 0 END) as presents,
+                    COUNT(DISTINCT a.attendance_date) as days_marked
+                FROM users u
+                JOIN attendance a ON a.student_id = u.user_id
+                JOIN classes c ON c.id = a.class_id
+                WHERE c.teacher_id = ? AND a.attendance_date >= date('now', '-30 days')
+                GROUP BY u.user_id, c.id
+                HAVING (CAST(presents AS FLOAT) / NULLIF(days_marked,0)) < 0.6
+                ORDER BY presents ASC
+                LIMIT 10
+            )
+            SELECT 'cls' as kind, class_id, class_name, marks, days_count,
+                NULL as user_id, NULL as name, NULL as email, NULL as presents, NULL as days_marked
+            FROM cls_agg
+            UNION ALL
+            SELECT 'risk', NULL, class_name, NULL, NULL, user_id, name, email, presents, days_marked
+            FROM risk
+            ORDER BY kind, presents, class_id
             """,
-            (teacher_id,),
+            (teacher_id, teacher_id),
         ).fetchall()
 
         classes = []
+        at_risk = []
         for r in rows:
+            if r["kind"] == "risk":
+                at_risk.append({key: r[key] for key in ("user_id", "name", "email", "class_name", "presents", "days_marked")})
+                continue
             marks = r["marks"] or 0
             days = r["days_count"] or 0
             avg = 0
@@ -392,28 +732,7 @@ def teacher_analytics():
                 avg = round(marks / days, 2)
             classes.append({"class_id": r["class_id"], "class_name": r["class_name"], "attendance_marks": marks, "days": days, "avg_marks_per_day": avg})
 
-        low_rows = conn.execute(
-            """
-            SELECT u.user_id, u.name, u.email, c.class_name,
-                SUM(CASE WHEN a.status = 'present' THEN 1 ELSE 0 END) as presents,
-                COUNT(DISTINCT a.attendance_date) as days_marked
-            FROM users u
-            JOIN attendance a ON a.student_id = u.user_id
-            JOIN classes c ON c.id = a.class_id
-            WHERE c.teacher_id = ? AND a.attendance_date >= date('now', '-30 days')
-            GROUP BY u.user_id, c.id
-            HAVING (CAST(presents AS FLOAT) / NULLIF(days_marked,0)) < 0.6
-            ORDER BY presents ASC
-            LIMIT 10
-            """,
-            (teacher_id,),
-        ).fetchall()
-
-        at_risk = [dict(r) for r in low_rows]
-
         return jsonify({"classes": classes, "at_risk_students": at_risk})
-    finally:
-        conn.close()
 
 
 # --- API: Student ---
@@ -430,34 +749,31 @@ def scan_qr():
     if not qr_manager.validate_token(token, session_id):
         return jsonify({"success": False, "message": "The QR code is invalid or has expired."}), 400
 
-    conn = db_manager.get_connection()
-    try:
-        today = datetime.now(timezone.utc).date().isoformat()
-        class_id = qr_manager.active_session.get("class_id") if qr_manager.active_session else None
-        if not class_id:
-            return jsonify({"success": False, "message": "The QR session is no longer active."}), 400
-        exists = conn.execute(
-            "SELECT 1 FROM attendance WHERE student_id = ? AND class_id = ? AND attendance_date = ?",
-            (session["user_id"], class_id, today),
-        ).fetchone()
-        if exists:
-            return jsonify({"success": False, "message": "You have already marked attendance for this class today."}), 409
-        conn.execute("INSERT INTO attendance (student_id, class_id, attendance_date) VALUES (?, ?, ?)", (session["user_id"], class_id, today))
-        conn.commit()
-        return jsonify({"success": True, "message": "Attendance marked successfully!"})
-    except sqlite3.Error:
-        app.logger.exception("Database error while marking attendance")
-        return jsonify({"success": False, "message": "A database error occurred."}), 500
-    finally:
-        conn.close()
+    with db_manager.connection() as conn:
+        try:
+            today = datetime.now(timezone.utc).date().isoformat()
+            class_id = qr_manager.active_session.get("class_id") if qr_manager.active_session else None
+            if not class_id:
+                return jsonify({"success": False, "message": "The QR session is no longer active."}), 400
+            # The UNIQUE(student_id, class_id, attendance_date) constraint does the dedupe; no row inserted means already marked.
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO attendance (student_id, class_id, attendance_date) VALUES (?, ?, ?)",
+                (session["user_id"], class_id, today),
+            )
+            conn.commit()
+            if cur.rowcount == 0:
+                return jsonify({"success": False, "message": "You have already marked attendance for this class today."}), 409
+            return jsonify({"success": True, "message": "Attendance marked successfully!"})
+        except sqlite3.Error:
+            app.logger.exception("Database error while marking attendance")
+            return jsonify({"success": False, "message": "A database error occurred."}), 500
 
 
 @app.route("/api/student/attendance-history", methods=["GET"])
 def get_attendance_history():
     if session.get("role") != "student":
         return jsonify({"error": "Only students can perform this action."}), 403
-    conn = db_manager.get_connection()
-    try:
+    with db_manager.connection() as conn:
         records = conn.execute(
             """
             SELECT a.attendance_date as date, a.status, c.class_name FROM attendance a
@@ -466,9 +782,7 @@ def get_attendance_history():
             """,
             (session["user_id"],),
         ).fetchall()
-        return jsonify({"attendance_records": [dict(row) for row in records]})
-    finally:
-        conn.close()
+        return jsonify({"attendance_records": records})
 
 
 if __name__ == "__main__":
@@ -481,15 +795,36 @@ if __name__ == "__main__":
     #  - Use ad-hoc SSL (Werkzeug) for development only:
     #      USE_ADHOC_SSL=1
     #  - Or run without SSL (http://localhost:5000) which is acceptable for camera access on localhost.
+    #  - For production, serve with gunicorn's threaded worker instead of the Werkzeug dev server:
+    #      USE_GUNICORN=1 (optional: GUNICORN_THREADS=16, GUNICORN_BIND=127.0.0.1:5000)
+    #    This execs: gunicorn -k gthread -w 1 --threads 16 -b 127.0.0.1:5000 app:app
+    #    Keep a single worker process: QR and login sessions live in process memory.
     app.logger.info("--- Campus Guardian Backend ---")
 
     # Read cert paths from environment to allow flexibility
     cert_file = os.environ.get("SSL_CERT_FILE", "cert.pem")
     key_file = os.environ.get("SSL_KEY_FILE", "key.pem")
     use_adhoc = os.environ.get("USE_ADHOC_SSL", "").lower() in ("1", "true", "yes")
-
+    use_gunicorn = os.environ.get("USE_GUNICORN", "").lower() in ("1", "true", "yes")
+    have_cert_files = bool(cert_file and key_file and os.path.exists(cert_file) and os.path.exists(key_file))
+
+    if use_gunicorn:
+        # Replace this process with the gunicorn CLI so app:app, with its database/QR state and
+        # background threads, is only loaded inside the worker and never in the gunicorn master.
+        bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5000")
+        threads = os.environ.get("GUNICORN_THREADS", "16")
+        argv = [
+            sys.executable, "-m", "gunicorn",
+            "-k", "gthread", "-w", "1", "--threads", threads, "-b", bind,
+            "--pythonpath", os.path.dirname(os.path.abspath(__file__)),
+        ]
+        if have_cert_files:
+            argv += ["--certfile", cert_file, "--keyfile", key_file]
+        argv.append("app:app")
+        app.logger.info(f"Starting gunicorn on {bind} with {threads} threads.")
+        os.execv(sys.executable, argv)
     # Prioritize explicit cert files if they both exist.
-    if cert_file and key_file and os.path.exists(cert_file) and os.path.exists(key_file):
+    elif have_cert_files:
         app.logger.info(f"Starting server at https://localhost:5000 using provided cert files: {cert_file}, {key_file}")
         app.run(debug=True, port=5000, ssl_context=(cert_file, key_file))
     else: